@@ -1,11 +1,21 @@
 # -*- coding: utf-8 -*-
 
-from django.db import models
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.db import (connections, models, router, transaction,
+    IntegrityError)
+from django.db.models import F, Max, Min
+from django.db.models.signals import class_prepared, post_delete, m2m_changed
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.encoding import force_text
 from django.utils.translation import ugettext_lazy as _
-from treebeard.mp_tree import MP_Node
+from treebeard.mp_tree import MP_Node, MP_NodeManager, MP_NodeQuerySet
 from sorl.thumbnail import ImageField
 
 from items.conf import is_default, settings, get_model, get_model_name
+from items.pagination import KeysetQuerySetMixin
 
 
 ITEM_TYPES = settings.ITEMS.get('ITEM_TYPES', (
@@ -14,6 +24,44 @@ ITEM_TYPES = settings.ITEMS.get('ITEM_TYPES', (
     ('LB', _('Labeled')),
 ))
 
+CHANGE_CREATE, CHANGE_UPDATE, CHANGE_DELETE = 'C', 'U', 'D'
+CHANGE_OPS = (
+    (CHANGE_CREATE, _('Create')),
+    (CHANGE_UPDATE, _('Update')),
+    (CHANGE_DELETE, _('Delete')),
+)
+CHANGELOG_BATCH_SIZE = settings.ITEMS.get('CHANGELOG_BATCH_SIZE', 1000)
+CHANGELOG_RETENTION = settings.ITEMS.get('CHANGELOG_RETENTION', None)
+CHANGELOG_COMPACT_SIZE = settings.ITEMS.get('CHANGELOG_COMPACT_SIZE', 100000)
+
+
+@contextmanager
+def _atomic(using):
+    """
+    Run a block in the caller's transaction, or in one of its own if there is
+    none. Never commits a transaction the caller opened.
+    """
+    if hasattr(transaction, 'atomic'):
+        with transaction.atomic(using=using):
+            yield
+        return
+
+    # Django < 1.6: the same forced-managed dance as QuerySet.update().
+    if transaction.is_managed(using=using):
+        yield
+        return
+    transaction.enter_transaction_management(using=using)
+    transaction.managed(True, using=using)
+    try:
+        yield
+    except Exception:
+        transaction.rollback(using=using)
+        raise
+    else:
+        transaction.commit(using=using)
+    finally:
+        transaction.leave_transaction_management(using=using)
+
 
 class Slugged(models.Model):
     slug = models.SlugField(verbose_name=_('Slug'))
@@ -56,6 +104,13 @@ class Imaged(models.Model):
         abstract = True
 
 
+class Timestamped(models.Model):
+    modified = models.DateTimeField(verbose_name=_('Modified'), auto_now=True)
+
+    class Meta:
+        abstract = True
+
+
 class URLed(models.Model):
     _url = models.CharField(max_length=512, null=True, blank=True)
 
@@ -67,7 +122,132 @@ class URLed(models.Model):
         abstract = True
 
 
-class BaseManufacturer(Named, Slugged, models.Model):
+class ChangeLogged(models.Model):
+    """
+    Records a ``ChangeEvent`` in the same transaction as every save. Deletes,
+    including cascades, and m2m changes are recorded by the handlers that
+    ``connect_change_log`` attaches to each subclass. Django before 1.7
+    commits m2m changes before their signal is sent, so those events only
+    share a transaction with the change if the caller opened one.
+    """
+
+    def save(self, *args, **kwargs):
+        op = CHANGE_CREATE if self._state.adding else CHANGE_UPDATE
+        using = kwargs.get('using') or \
+            router.db_for_write(self.__class__, instance=self)
+        with _atomic(using):
+            super(ChangeLogged, self).save(*args, **kwargs)
+            log_changes(self.__class__, [self.pk], op, using)
+
+    class Meta:
+        abstract = True
+
+
+class TreeChangeLogged(ChangeLogged):
+    """ Also records the subtree whose paths change on ``move``. """
+
+    def move(self, target, pos=None):
+        cls = self.__class__
+        using = router.db_for_write(cls, instance=self)
+        nodes = cls._base_manager.using(using)
+        with _atomic(using):
+            super(TreeChangeLogged, self).move(target, pos)
+            node = nodes.get(pk=self.pk)
+            pks = nodes.filter(path__startswith=node.path,
+                depth__gte=node.depth).values_list('pk', flat=True)
+            log_changes(cls, pks, CHANGE_UPDATE, using)
+
+    class Meta:
+        abstract = True
+
+
+def _allocate_sequences(count, using):
+    counters = ChangeCounter.objects.using(using).filter(pk=1)
+    if not counters.update(value=F('value') + count):
+        # First event ever. A concurrent writer may create the row first;
+        # the savepoint keeps that error from aborting our transaction.
+        sid = transaction.savepoint(using=using)
+        try:
+            ChangeCounter.objects.using(using).create(pk=1, value=count)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid, using=using)
+            counters.update(value=F('value') + count)
+        else:
+            transaction.savepoint_commit(sid, using=using)
+    last = counters.values_list('value', flat=True)[0]
+    return range(last - count + 1, last + 1)
+
+
+def log_changes(model, pks, op, using=None):
+    pks = list(pks)
+    if not pks:
+        return
+    using = using or router.db_for_write(ChangeEvent)
+    # Deferred (.only()/.defer()) and proxy classes log as the real model.
+    opts = model._meta.concrete_model._meta
+    label = '%s.%s' % (opts.app_label, opts.object_name)
+    with _atomic(using):
+        sequences = _allocate_sequences(len(pks), using)
+        ChangeEvent.objects.using(using).bulk_create([
+            ChangeEvent(sequence=sequence, model=label,
+                object_pk=force_text(pk), op=op)
+            for sequence, pk in zip(sequences, pks)
+        ])
+
+
+def _m2m_related_pks(through, instance, reverse):
+    owner = through._meta.auto_created
+    field = [f for f in owner._meta.many_to_many
+        if f.rel.through is through][0]
+    source, target = field.m2m_field_name(), field.m2m_reverse_field_name()
+    if reverse:
+        source, target = target, source
+    return set(through._base_manager.filter(**{source: instance.pk})
+        .values_list(target, flat=True))
+
+
+def log_delete(sender, instance, using, **kwargs):
+    log_changes(sender, [instance.pk], CHANGE_DELETE, using)
+
+
+def log_m2m_change(sender, instance, action, reverse, model, pk_set, using,
+        **kwargs):
+    if action == 'pre_clear':
+        # post_clear has no pk_set, so remember who is about to be cleared.
+        instance.__dict__.setdefault('_change_log_cleared', {})[sender] = \
+            _m2m_related_pks(sender, instance, reverse)
+        return
+    if action == 'post_clear':
+        pk_set = instance.__dict__.get('_change_log_cleared', {}) \
+            .pop(sender, None)
+    elif action not in ('post_add', 'post_remove'):
+        return
+    if isinstance(instance, ChangeLogged):
+        log_changes(instance.__class__, [instance.pk], CHANGE_UPDATE, using)
+    if pk_set and issubclass(model, ChangeLogged):
+        log_changes(model, pk_set, CHANGE_UPDATE, using)
+
+
+@receiver(class_prepared)
+def connect_change_log(sender, **kwargs):
+    """
+    Listen only on change logged models and their m2m tables; a listener
+    without a sender would disable fast deletes for every model.
+    """
+    if issubclass(sender, ChangeLogged):
+        post_delete.connect(log_delete, sender=sender)
+        # A multi-table child's delete also deletes its parent rows; only
+        # the child should be logged. Proxies list their concrete model as
+        # a parent without a link and must leave it connected.
+        for parent, link in sender._meta.parents.items():
+            if link is not None:
+                post_delete.disconnect(log_delete, sender=parent)
+    owner = sender._meta.auto_created
+    if isinstance(owner, type) and issubclass(owner, ChangeLogged):
+        m2m_changed.connect(log_m2m_change, sender=sender)
+
+
+class BaseManufacturer(Named, Slugged, ChangeLogged, models.Model):
     """ The manufacturer of an item class """
 
     class Meta:
@@ -76,16 +256,34 @@ class BaseManufacturer(Named, Slugged, models.Model):
         abstract = True
 
 
-class BaseCategory(Named, Slugged, Ordered, Imaged, Described, URLed, MP_Node, models.Model):
+class BaseCategoryQuerySet(KeysetQuerySetMixin, MP_NodeQuerySet):
+    pass
+
+
+class BaseCategoryManager(MP_NodeManager):
+    def get_query_set(self):
+        return BaseCategoryQuerySet(self.model, using=self._db) \
+            .order_by('path')
+
+    def keyset_page(self, *args, **kwargs):
+        return self.get_query_set().keyset_page(*args, **kwargs)
+
+
+class BaseCategory(Named, Slugged, Ordered, Imaged, Described, URLed, Timestamped, TreeChangeLogged, MP_Node, models.Model):
     """ Category of the item class """
     node_order_by = ['order', 'name']
     _url_parts = None
 
+    objects = BaseCategoryManager()
+
     def save(self, *args, **kwargs):
-        self._update_url()
-        for item in self.items.all():
-            item.save()
-        super(BaseCategory, self).save(*args, **kwargs)
+        using = kwargs.get('using') or \
+            router.db_for_write(self.__class__, instance=self)
+        with _atomic(using):
+            self._update_url()
+            for item in self.items.all():
+                item.save()
+            super(BaseCategory, self).save(*args, **kwargs)
 
     @property
     def root(self):
@@ -107,15 +305,34 @@ class BaseCategory(Named, Slugged, Ordered, Imaged, Described, URLed, MP_Node, m
     class Meta:
         verbose_name = _('Category')
         verbose_name_plural = _('Categories')
+        index_together = [['order', 'name', 'id']]
         abstract = True
 
+class BaseItemQuerySet(KeysetQuerySetMixin, models.query.QuerySet):
+    def in_category(self, category):
+        """
+        Items whose primary category is ``category`` or below it. Filters on
+        ``category_id`` rather than joining, so that a leaf category is served
+        by the ``(category, order, name, id)`` index.
+        """
+        subtree = category.__class__._base_manager \
+            .filter(path__startswith=category.path).values('pk')
+        return self.filter(category__in=subtree)
+
+
 class BaseItemManager(models.Manager):
     def get_query_set(self):
-        return super(BaseItemManager, self).get_query_set() \
+        return BaseItemQuerySet(self.model, using=self._db) \
             .prefetch_related('attribute_rows').select_related('category')
 
+    def in_category(self, category):
+        return self.get_query_set().in_category(category)
+
+    def keyset_page(self, *args, **kwargs):
+        return self.get_query_set().keyset_page(*args, **kwargs)
 
-class BaseItem(Named, Slugged, Described, URLed, Ordered, MP_Node, models.Model):
+
+class BaseItem(Named, Slugged, Described, URLed, Timestamped, Ordered, TreeChangeLogged, MP_Node, models.Model):
     """ This is the model it all revolves around. """
     node_order_by = ['order', 'name']
     _url_parts = None
@@ -184,10 +401,14 @@ class BaseItem(Named, Slugged, Described, URLed, Ordered, MP_Node, models.Model)
     class Meta:
         verbose_name = _('Item Class')
         verbose_name_plural = _('Item Classes')
+        index_together = [
+            ['order', 'name', 'id'],
+            ['category', 'order', 'name', 'id'],
+        ]
         abstract = True
 
 
-class BaseItemAttributeRow(Ordered, models.Model):
+class BaseItemAttributeRow(Ordered, ChangeLogged, models.Model):
     name = models.CharField(verbose_name=_('Name'), max_length=255, blank=True, null=True)
     item = models.ForeignKey(get_model_name('Item'), related_name='attribute_rows')
     _attributes = None
@@ -205,7 +426,7 @@ class BaseItemAttributeRow(Ordered, models.Model):
         ordering = ('order',)
 
 
-class BaseItemAttributeClass(Named, models.Model):
+class BaseItemAttributeClass(Named, ChangeLogged, models.Model):
     class Meta:
         verbose_name = _('Item Attribute Class')
         verbose_name_plural = _('Item Attribute Classes')
@@ -217,7 +438,7 @@ class BaseItemAttributeManager(models.Manager):
         return super(BaseItemAttributeManager, self).get_query_set() \
             .select_related('cls')
 
-class BaseItemAttribute(Ordered, models.Model):
+class BaseItemAttribute(Ordered, ChangeLogged, models.Model):
     cls = models.ForeignKey(get_model_name('ItemAttributeClass'),
         verbose_name=_('Class'),  related_name="attributes")
     text = models.TextField(verbose_name=_('Text'))
@@ -235,7 +456,7 @@ class BaseItemAttribute(Ordered, models.Model):
         abstract = True
 
 
-class BaseItemImage(Named, Ordered, Imaged, models.Model):
+class BaseItemImage(Named, Ordered, Imaged, ChangeLogged, models.Model):
     item = models.ForeignKey(get_model_name('Item'), related_name='images')
 
     def __unicode__(self):
@@ -247,7 +468,7 @@ class BaseItemImage(Named, Ordered, Imaged, models.Model):
         abstract = True
 
 
-class BaseItemInstance(models.Model):
+class BaseItemInstance(ChangeLogged, models.Model):
     label = models.CharField(verbose_name=_('Label'), max_length=255,
         null=True, blank=True)
     base_stock = models.PositiveIntegerField(verbose_name=_('Base Stock'),
@@ -274,6 +495,87 @@ class BaseItemInstance(models.Model):
         abstract = True
 
 
+class ChangeEventManager(models.Manager):
+    def since(self, sequence=0, limit=None):
+        """
+        The next batch of events after ``sequence``, oldest first. Pass the
+        ``sequence`` of the last event to fetch the batch after it.
+        """
+        limit = limit or CHANGELOG_BATCH_SIZE
+        return list(self.filter(sequence__gt=sequence)
+            .order_by('sequence')[:limit])
+
+    def compact(self, before=None):
+        """
+        Drop events older than ``CHANGELOG_RETENTION`` days, then every event
+        up to ``before`` that is superseded by a later one for the same object.
+        Superseded events are deleted with one query per
+        ``CHANGELOG_COMPACT_SIZE`` sequences, each looking up later events
+        through the ``(model, object_pk)`` index.
+        """
+        if CHANGELOG_RETENTION is not None:
+            self.filter(created__lt=timezone.now() -
+                timedelta(days=CHANGELOG_RETENTION)).delete()
+
+        bounds = self.aggregate(first=Min('sequence'), last=Max('sequence'))
+        lower = bounds['first']
+        if before is None:
+            before = bounds['last']
+        if lower is None or before is None:
+            return
+        qn = connections[self.db].ops.quote_name
+        table = qn(self.model._meta.db_table)
+        superseded = (
+            'EXISTS (SELECT 1 FROM %(table)s later'
+            ' WHERE later.%(model)s = %(table)s.%(model)s'
+            ' AND later.%(object_pk)s = %(table)s.%(object_pk)s'
+            ' AND later.%(sequence)s > %(table)s.%(sequence)s)'
+        ) % {
+            'table': table,
+            'model': qn('model'),
+            'object_pk': qn('object_pk'),
+            'sequence': qn('sequence'),
+        }
+        while lower <= before:
+            upper = min(lower + CHANGELOG_COMPACT_SIZE, before + 1)
+            self.filter(sequence__gte=lower, sequence__lt=upper) \
+                .extra(where=[superseded]).delete()
+            lower = upper
+
+
+class ChangeCounter(models.Model):
+    """
+    Single row handing out ``ChangeEvent`` sequences. Writers hold its row
+    lock until they commit, so sequences become visible in commit order and
+    are never reused, even once every event has been compacted away.
+    """
+    value = models.BigIntegerField(default=0)
+
+
+class ChangeEvent(models.Model):
+    """
+    A change to a catalog object. ``sequence`` follows commit order, so it
+    doubles as the cursor for consumers syncing deltas.
+    """
+    sequence = models.BigIntegerField(primary_key=True)
+    model = models.CharField(verbose_name=_('Model'), max_length=255)
+    object_pk = models.CharField(verbose_name=_('Object ID'), max_length=255)
+    op = models.CharField(verbose_name=_('Operation'), max_length=1,
+        choices=CHANGE_OPS)
+    created = models.DateTimeField(verbose_name=_('Created'),
+        auto_now_add=True, db_index=True)
+
+    objects = ChangeEventManager()
+
+    def __unicode__(self):
+        return u'%s %s %s' % (self.op, self.model, self.object_pk)
+
+    class Meta:
+        verbose_name = _('Change Event')
+        verbose_name_plural = _('Change Events')
+        index_together = [['model', 'object_pk']]
+
+
 if is_default('Manufacturer'):
     class Manufacturer(BaseManufacturer):
         class Meta:
@@ -282,13 +584,13 @@ if is_default('Manufacturer'):
 
 if is_default('Category'):
     class Category(BaseCategory):
-        class Meta:
+        class Meta(BaseCategory.Meta):
             managed = is_default('Category')
 
 
 if is_default('Item'):
     class Item(BaseItem):
-        class Meta:
+        class Meta(BaseItem.Meta):
             managed = is_default('Item')
 
 
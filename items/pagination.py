@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Keyset (cursor) pagination for item and category querysets.
+
+Instead of ``OFFSET``, each page filters on the sort key of the last row of
+the previous page, so deep pages cost the same as the first one and rows
+inserted meanwhile don't shift the results. The primary key is always
+appended to the ordering to make the sort key unique. Rows are sorted by
+plain column values, so an index on the ordering fields plus the primary key
+serves every page; NULLs go wherever the database puts them natively.
+"""
+
+import base64
+import json
+import operator
+from functools import reduce
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections
+from django.db.models import Q
+
+from items.conf import settings
+
+
+PAGE_SIZE = settings.ITEMS.get('PAGE_SIZE', 20)
+
+
+def encode_cursor(values):
+    data = json.dumps(values, cls=DjangoJSONEncoder, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        data = base64.urlsafe_b64decode(str(cursor))
+        values = json.loads(data.decode('utf-8'))
+    except (TypeError, ValueError):
+        raise ValueError('Invalid cursor: %r' % cursor)
+    if not isinstance(values, list):
+        raise ValueError('Invalid cursor: %r' % cursor)
+    return values
+
+
+class KeysetPage(object):
+    """ One page of results and the cursor to pass for the next one. """
+
+    def __init__(self, object_list, next_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+class KeysetQuerySetMixin(object):
+    """
+    Adds ``keyset_page`` to a queryset. ``ordering`` defaults to the model's
+    ``node_order_by``; pass ``['path']`` for materialized path (tree) order.
+    Fields may be prefixed with ``-`` and must be local to the model.
+    """
+
+    def _keyset_fields(self, ordering):
+        opts = self.model._meta
+        fields = []
+        for name in ordering:
+            descending = name.startswith('-')
+            field = opts.get_field(name.lstrip('-'))
+            if field.primary_key:
+                continue
+            fields.append((field, descending))
+        fields.append((opts.pk, False))
+        return fields
+
+    def _keyset_ordered(self, fields):
+        return self.order_by(*[
+            ('-' if descending else '') + field.name
+            for field, descending in fields
+        ])
+
+    def _nulls_first(self, descending):
+        # PostgreSQL and Oracle sort NULLs as larger than any value, SQLite
+        # and MySQL as smaller.
+        nulls_high = connections[self.db].vendor in ('postgresql', 'oracle')
+        return nulls_high == descending
+
+    def _keyset_after(self, fields, values):
+        if len(values) != len(fields):
+            raise ValueError('Cursor does not match ordering')
+        conditions = []
+        equal = Q()
+        for (field, descending), value in zip(fields, values):
+            name = field.name
+            nulls_first = self._nulls_first(descending)
+            if value is None:
+                after = Q(**{name + '__isnull': False}) if nulls_first else None
+                same = Q(**{name + '__isnull': True})
+            else:
+                after = Q(**{name + ('__lt' if descending else '__gt'): value})
+                if field.null and not nulls_first:
+                    after |= Q(**{name + '__isnull': True})
+                same = Q(**{name: value})
+            if after is not None:
+                conditions.append(equal & after)
+            equal &= same
+        field, descending = fields[0]
+        return self.filter(self._keyset_bound(field, descending, values[0]),
+            reduce(operator.or_, conditions))
+
+    def _keyset_bound(self, field, descending, value):
+        """
+        A redundant range on the leading field. The OR chain alone can't be
+        used as an index condition, this can.
+        """
+        if value is None:
+            # Either only NULLs follow, which the OR chain already says, or
+            # every non-NULL value does, which no range can narrow.
+            return Q()
+        bound = Q(**{field.name + ('__lte' if descending else '__gte'): value})
+        if field.null and not self._nulls_first(descending):
+            bound |= Q(**{field.name + '__isnull': True})
+        return bound
+
+    def keyset_page(self, cursor=None, size=None, ordering=None):
+        """
+        Return a ``KeysetPage`` of at most ``size`` objects following
+        ``cursor`` (``None`` for the first page). Raises ``ValueError`` for a
+        cursor that doesn't decode or doesn't fit ``ordering``.
+        """
+        size = size or PAGE_SIZE
+        fields = self._keyset_fields(ordering or self.model.node_order_by)
+        qs = self
+        if cursor is not None:
+            qs = qs._keyset_after(fields, decode_cursor(cursor))
+        objects = list(qs._keyset_ordered(fields)[:size + 1])
+
+        next_cursor = None
+        if len(objects) > size:
+            objects = objects[:size]
+            last = objects[-1]
+            next_cursor = encode_cursor([
+                getattr(last, field.attname) for field, _ in fields
+            ])
+        return KeysetPage(objects, next_cursor)
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming sitemap generation for large catalogs.
+
+URLs and timestamps are read straight from the stored ``_url`` and
+``modified`` columns in pk-ordered keyset chunks, so no model instances are
+built and ``url_parts`` is never walked. Each model is split into gzipped
+files of at most ``SITEMAP_LIMIT`` URLs; every file covers a contiguous pk
+range, which is recorded in a manifest next to the index so that later runs
+can rewrite only the files whose rows changed.
+"""
+
+import gzip
+import itertools
+import json
+import os
+from xml.sax.saxutils import escape
+
+from django.db.models import Count, Max
+from django.utils import timezone
+
+from items.conf import settings, get_model
+
+
+SITEMAP_LIMIT = settings.ITEMS.get('SITEMAP_LIMIT', 50000)
+SITEMAP_CHUNK_SIZE = settings.ITEMS.get('SITEMAP_CHUNK_SIZE', 5000)
+SITEMAP_MODELS = settings.ITEMS.get('SITEMAP_MODELS', ('Category', 'Item'))
+
+INDEX_NAME = 'sitemap.xml'
+MANIFEST_NAME = 'sitemap.json'
+
+URLSET_HEAD = (u'<?xml version="1.0" encoding="UTF-8"?>\n'
+    u'<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+URLSET_TAIL = u'</urlset>\n'
+INDEX_HEAD = (u'<?xml version="1.0" encoding="UTF-8"?>\n'
+    u'<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+INDEX_TAIL = u'</sitemapindex>\n'
+
+
+def _timestamp(value):
+    if value is None:
+        return None
+    # W3C datetimes need an offset, which naive values (USE_TZ=False) lack.
+    if timezone.is_naive(value):
+        value = timezone.make_aware(value, timezone.get_default_timezone())
+    return value.isoformat()
+
+
+def _entry(loc, lastmod, tag):
+    if lastmod:
+        return u'<%s><loc>%s</loc><lastmod>%s</lastmod></%s>\n' % (
+            tag, escape(loc), lastmod, tag)
+    return u'<%s><loc>%s</loc></%s>\n' % (tag, escape(loc), tag)
+
+
+def url_queryset(model, lower=None, upper=None):
+    """ Rows of ``model`` with a stored URL, with ``lower <= pk < upper``. """
+    # _base_manager skips the prefetching done by the item manager.
+    qs = get_model(model)._base_manager.filter(_url__isnull=False)
+    if lower is not None:
+        qs = qs.filter(pk__gte=lower)
+    if upper is not None:
+        qs = qs.filter(pk__lt=upper)
+    return qs
+
+
+def iter_urls(model, lower=None, upper=None, chunk_size=None):
+    """
+    Yield ``(pk, url, modified)`` for ``model`` in pk order, fetching one
+    keyset chunk at a time so every query is an index range scan.
+    """
+    chunk_size = chunk_size or SITEMAP_CHUNK_SIZE
+    qs = url_queryset(model, lower, upper).order_by('pk')
+    last = None
+    while True:
+        chunk = qs if last is None else qs.filter(pk__gt=last)
+        rows = list(chunk.values_list('pk', '_url', 'modified')[:chunk_size])
+        for row in rows:
+            yield row
+        if len(rows) < chunk_size:
+            return
+        last = rows[-1][0]
+
+
+class SitemapGenerator(object):
+    """
+    Writes ``<model>-<pk>.xml.gz`` files, a ``sitemap.xml`` index and a
+    ``sitemap.json`` manifest into ``directory``.
+
+    ``base_url`` is prepended to the stored URLs, ``sitemap_url`` to the file
+    names listed in the index (defaults to ``base_url``).
+    """
+
+    def __init__(self, directory, base_url, sitemap_url=None, models=None,
+            limit=None, chunk_size=None):
+        self.directory = directory
+        self.base_url = base_url.rstrip('/')
+        self.sitemap_url = (sitemap_url or base_url).rstrip('/')
+        self.models = models or SITEMAP_MODELS
+        self.limit = limit or SITEMAP_LIMIT
+        self.chunk_size = chunk_size or SITEMAP_CHUNK_SIZE
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def generate(self, incremental=False):
+        """
+        Write all sitemap files and the index. With ``incremental``, files
+        whose pk range still has the row count and latest ``modified`` stored
+        in the manifest are left alone. Returns the names of rewritten files.
+        """
+        manifest = self.read_manifest() if incremental else {}
+        entries, written = [], []
+        for model in self.models:
+            model_entries = self._generate_model(model,
+                manifest.get(model, []), written)
+            entries.extend(model_entries)
+            manifest[model] = model_entries
+
+        self.write_index(entries)
+        self.write_manifest(dict((m, manifest[m]) for m in self.models))
+
+        # Only once the new index is live can files it dropped be removed.
+        self.prune(set(e['name'] for e in entries))
+        return written
+
+    def prune(self, keep):
+        """
+        Remove this generator's sitemap files that aren't in ``keep`` and any
+        temporary files left behind by an interrupted run. Files belonging to
+        other models or apps are left alone.
+        """
+        prefixes = tuple('%s-' % model.lower() for model in self.models)
+        temporary = (INDEX_NAME + '.tmp', MANIFEST_NAME + '.tmp')
+        for name in os.listdir(self.directory):
+            if not name.startswith(prefixes):
+                if name in temporary:
+                    os.remove(self.path(name))
+                continue
+            if name.endswith('.xml.gz.tmp') or (
+                    name.endswith('.xml.gz') and name not in keep):
+                os.remove(self.path(name))
+
+    def _generate_model(self, model, old_entries, written):
+        if not old_entries:
+            new_entries = self.write_range(model)
+            written.extend(e['name'] for e in new_entries)
+            return new_entries
+
+        entries = []
+        for i, entry in enumerate(old_entries):
+            # The first range is open below and the last open above, so rows
+            # outside the recorded pks are still picked up.
+            lower = entry['first'] if i else None
+            upper = old_entries[i + 1]['first'] \
+                if i + 1 < len(old_entries) else None
+            if self.range_unchanged(model, lower, upper, entry):
+                entries.append(entry)
+                continue
+            new_entries = self.write_range(model, lower, upper, entry['first'])
+            written.extend(e['name'] for e in new_entries)
+            entries.extend(new_entries)
+        return entries
+
+    def range_unchanged(self, model, lower, upper, entry):
+        stats = url_queryset(model, lower, upper).aggregate(
+            count=Count('pk'), lastmod=Max('modified'))
+        return (stats['count'] == entry['count']
+            and _timestamp(stats['lastmod']) == entry['lastmod'])
+
+    def write_range(self, model, lower=None, upper=None, first=None):
+        """
+        Stream the rows of ``model`` in ``[lower, upper)`` into as many files
+        as needed. The first file is keyed on ``first`` (or its first pk) so a
+        rewritten range keeps its file name.
+        """
+        entries = []
+        rows = iter_urls(model, lower, upper, self.chunk_size)
+        while True:
+            row = next(rows, None)
+            if row is None:
+                return entries
+            key = row[0] if first is None else first
+            first = None
+            chunk = itertools.chain([row], itertools.islice(rows, self.limit - 1))
+            entries.append(self.write_file(model, key, chunk))
+
+    def write_file(self, model, key, rows):
+        name = '%s-%s.xml.gz' % (model.lower(), key)
+        count, lastmod = 0, None
+        tmp = self.path(name + '.tmp')
+        f = gzip.open(tmp, 'wb')
+        try:
+            f.write(URLSET_HEAD.encode('utf-8'))
+            for pk, url, modified in rows:
+                if modified is not None and (lastmod is None
+                        or modified > lastmod):
+                    lastmod = modified
+                count += 1
+                f.write(_entry(self.base_url + url, _timestamp(modified),
+                    'url').encode('utf-8'))
+            f.write(URLSET_TAIL.encode('utf-8'))
+        finally:
+            f.close()
+        os.rename(tmp, self.path(name))
+        return {
+            'name': name,
+            'first': key,
+            'count': count,
+            'lastmod': _timestamp(lastmod),
+        }
+
+    def write_index(self, entries):
+        tmp = self.path(INDEX_NAME + '.tmp')
+        f = open(tmp, 'wb')
+        try:
+            f.write(INDEX_HEAD.encode('utf-8'))
+            for entry in entries:
+                f.write(_entry('/'.join([self.sitemap_url, entry['name']]),
+                    entry['lastmod'], 'sitemap').encode('utf-8'))
+            f.write(INDEX_TAIL.encode('utf-8'))
+        finally:
+            f.close()
+        os.rename(tmp, self.path(INDEX_NAME))
+
+    def read_manifest(self):
+        try:
+            f = open(self.path(MANIFEST_NAME))
+        except IOError:
+            return {}
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+
+    def write_manifest(self, manifest):
+        tmp = self.path(MANIFEST_NAME + '.tmp')
+        f = open(tmp, 'w')
+        try:
+            json.dump(manifest, f)
+        finally:
+            f.close()
+        os.rename(tmp, self.path(MANIFEST_NAME))
+
+
+def generate_sitemaps(directory, base_url, sitemap_url=None,
+        incremental=False, **kwargs):
+    """ Shortcut for ``SitemapGenerator(...).generate(incremental)``. """
+    generator = SitemapGenerator(directory, base_url, sitemap_url, **kwargs)
+    return generator.generate(incremental)
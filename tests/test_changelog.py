@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_changelog
+------------
+
+Tests for the change event feed in `items.models`.
+"""
+
+from datetime import timedelta
+
+import mock
+from django.contrib.sites.models import Site
+from django.db import transaction
+from django.db.models import Max
+from django.db.models.signals import m2m_changed, post_delete
+from django.test import TestCase
+from django.utils import timezone
+
+from items.models import (Category, ChangeCounter, ChangeEvent, Item,
+    ItemAttributeRow, Manufacturer, CHANGE_CREATE, CHANGE_DELETE,
+    CHANGE_UPDATE)
+
+
+def label(obj):
+    return 'items.%s' % obj.__class__.__name__
+
+
+class TestChangeLog(TestCase):
+
+    def setUp(self):
+        self.manufacturer = Manufacturer.objects.create(name='Acme',
+            slug='acme')
+        self.tools = Category.add_root(name='Tools', slug='tools')
+        self.saws = self.tools.add_child(name='Saws', slug='saws')
+        self.paint = Category.add_root(name='Paint', slug='paint')
+        self.item = Item.add_root(name='Saw', slug='saw',
+            category=self.saws, manufacturer=self.manufacturer)
+
+    def cursor(self):
+        return ChangeEvent.objects.aggregate(
+            last=Max('sequence'))['last'] or 0
+
+    def events(self, since=0):
+        return [
+            (e.model, e.object_pk, e.op)
+            for e in ChangeEvent.objects.since(since, limit=1000)
+        ]
+
+    def event(self, obj, op):
+        return (label(obj), str(obj.pk), op)
+
+    def test_create(self):
+        self.assertIn(self.event(self.manufacturer, CHANGE_CREATE),
+            self.events())
+        self.assertIn(self.event(self.item, CHANGE_CREATE), self.events())
+
+    def test_update(self):
+        cursor = self.cursor()
+        self.manufacturer.name = 'Acme Ltd'
+        self.manufacturer.save()
+        self.assertEqual(self.events(cursor),
+            [self.event(self.manufacturer, CHANGE_UPDATE)])
+
+    def test_delete(self):
+        cursor = self.cursor()
+        manufacturer = Manufacturer.objects.create(name='Other', slug='other')
+        event = self.event(manufacturer, CHANGE_DELETE)
+        manufacturer.delete()
+        self.assertEqual(self.events(cursor)[-1], event)
+
+    def test_cascade_delete(self):
+        cursor = self.cursor()
+        expected = [
+            self.event(self.item, CHANGE_DELETE),
+            self.event(self.saws, CHANGE_DELETE),
+        ]
+        Category.objects.get(pk=self.saws.pk).delete()
+        events = self.events(cursor)
+        for event in expected:
+            self.assertIn(event, events)
+
+    def test_deferred_instance_label(self):
+        cursor = self.cursor()
+        item = Item.objects.only('name').get(pk=self.item.pk)
+        item.save()
+        item.delete()
+        self.assertEqual(self.events(cursor), [
+            ('items.Item', str(self.item.pk), CHANGE_UPDATE),
+            ('items.Item', str(self.item.pk), CHANGE_DELETE),
+        ])
+
+    def test_multi_table_child_logged_once(self):
+        row = ItemAttributeRow.objects.create(name='Size', item=self.item)
+        pk = row.pk
+        cursor = self.cursor()
+        row.delete()
+        self.assertEqual(self.events(cursor),
+            [('items.ItemAttributeRow', str(pk), CHANGE_DELETE)])
+
+    def test_move_logs_subtree(self):
+        child = Category.objects.get(pk=self.saws.pk).add_child(
+            name='Bow Saws', slug='bow-saws')
+        cursor = self.cursor()
+        Category.objects.get(pk=self.saws.pk).move(self.paint, 'sorted-child')
+        events = self.events(cursor)
+        self.assertIn(self.event(self.saws, CHANGE_UPDATE), events)
+        self.assertIn(self.event(child, CHANGE_UPDATE), events)
+        self.assertNotIn(self.event(self.tools, CHANGE_UPDATE), events)
+
+    def test_m2m_add_and_clear(self):
+        cursor = self.cursor()
+        self.item.categories.add(self.paint)
+        self.assertEqual(sorted(self.events(cursor)), sorted([
+            self.event(self.item, CHANGE_UPDATE),
+            self.event(self.paint, CHANGE_UPDATE),
+        ]))
+
+        cursor = self.cursor()
+        self.item.categories.clear()
+        self.assertEqual(sorted(self.events(cursor)), sorted([
+            self.event(self.item, CHANGE_UPDATE),
+            self.event(self.paint, CHANGE_UPDATE),
+        ]))
+
+    def test_m2m_reverse_clear(self):
+        self.item.categories.add(self.paint)
+        cursor = self.cursor()
+        self.paint.items_extra.clear()
+        self.assertEqual(sorted(self.events(cursor)), sorted([
+            self.event(self.paint, CHANGE_UPDATE),
+            self.event(self.item, CHANGE_UPDATE),
+        ]))
+
+    def test_listeners_only_on_catalog_models(self):
+        self.assertTrue(post_delete.has_listeners(Manufacturer))
+        self.assertTrue(post_delete.has_listeners(Item))
+        self.assertTrue(m2m_changed.has_listeners(Item.categories.through))
+        self.assertFalse(post_delete.has_listeners(Site))
+        self.assertFalse(post_delete.has_listeners(ChangeEvent))
+
+    def test_since_batches(self):
+        cursor = self.cursor()
+        for i in range(5):
+            Manufacturer.objects.create(name='M%d' % i, slug='m%d' % i)
+        seen = []
+        while True:
+            batch = ChangeEvent.objects.since(cursor, limit=2)
+            if not batch:
+                break
+            self.assertTrue(len(batch) <= 2)
+            seen.extend(batch)
+            cursor = batch[-1].sequence
+        sequences = [e.sequence for e in seen]
+        self.assertEqual(len(seen), 5)
+        self.assertEqual(sequences, sorted(sequences))
+        self.assertEqual(len(set(sequences)), 5)
+
+    def test_compact_keeps_latest(self):
+        for name in ('A', 'B', 'C'):
+            self.manufacturer.name = name
+            self.manufacturer.save()
+        ChangeEvent.objects.compact()
+        events = [e for e in self.events()
+            if e[:2] == self.event(self.manufacturer, None)[:2]]
+        self.assertEqual(events, [self.event(self.manufacturer,
+            CHANGE_UPDATE)])
+
+    def test_compact_before(self):
+        self.manufacturer.save()
+        before = self.cursor()
+        self.manufacturer.save()
+        ChangeEvent.objects.compact(before)
+        key = self.event(self.manufacturer, None)[:2]
+        remaining = ChangeEvent.objects.filter(model=key[0],
+            object_pk=key[1])
+        self.assertEqual(remaining.count(), 1)
+        self.assertTrue(remaining[0].sequence > before)
+
+        # Superseded events after ``before`` are kept.
+        cursor = self.cursor()
+        self.item.save()
+        self.item.save()
+        ChangeEvent.objects.compact(cursor)
+        self.assertEqual(ChangeEvent.objects.filter(
+            model='items.Item', object_pk=str(self.item.pk)).count(), 2)
+
+    def test_compact_in_chunks(self):
+        for i in range(4):
+            self.manufacturer.save()
+            self.item.save()
+        expected = ChangeEvent.objects.values('model', 'object_pk') \
+            .distinct().count()
+        with mock.patch('items.models.CHANGELOG_COMPACT_SIZE', 2):
+            ChangeEvent.objects.compact()
+        self.assertEqual(ChangeEvent.objects.count(), expected)
+
+    def test_compact_retention(self):
+        ChangeEvent.objects.update(
+            created=timezone.now() - timedelta(days=365))
+        self.manufacturer.save()
+        with mock.patch('items.models.CHANGELOG_RETENTION', 30):
+            ChangeEvent.objects.compact()
+        self.assertEqual(self.events(),
+            [self.event(self.manufacturer, CHANGE_UPDATE)])
+
+    def test_counter_created_on_first_event(self):
+        ChangeCounter.objects.all().delete()
+        ChangeEvent.objects.all().delete()
+        self.manufacturer.save()
+        self.assertEqual(self.cursor(), 1)
+
+    def test_sequences_not_reused(self):
+        last = self.cursor()
+        ChangeEvent.objects.all().delete()
+        self.manufacturer.save()
+        self.assertEqual(self.cursor(), last + 1)
+
+    def test_rolled_back_with_write(self):
+        if not hasattr(transaction, 'atomic'):
+            return
+        cursor = self.cursor()
+        try:
+            with transaction.atomic():
+                Manufacturer.objects.create(name='Gone', slug='gone')
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        self.assertEqual(self.events(cursor), [])
+        self.assertFalse(Manufacturer.objects.filter(slug='gone').exists())
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_pagination
+------------
+
+Tests for the `items.pagination` module.
+"""
+
+import re
+
+from django.db import connection
+from django.test import TestCase
+
+from items.models import Category, Item, Manufacturer
+from items.pagination import decode_cursor, encode_cursor
+
+
+class TestKeysetPagination(TestCase):
+
+    def setUp(self):
+        self.manufacturer = Manufacturer.objects.create(name='Acme',
+            slug='acme')
+        self.tools = Category.add_root(name='Tools', slug='tools')
+        self.saws = self.tools.add_child(name='Saws', slug='saws')
+        self.paint = Category.add_root(name='Paint', slug='paint')
+        for order, name, category in (
+                (2, 'Hammer', self.tools),
+                (None, 'Wrench', self.tools),
+                (1, 'Mallet', self.tools),
+                (2, 'Chisel', self.saws),
+                (None, 'Awl', self.saws),
+                (2, 'Chisel', self.saws),
+                (1, 'Brush', self.paint)):
+            self.make_item(order, name, category)
+
+    def make_item(self, order, name, category):
+        return Item.add_root(order=order, name=name, slug=name.lower(),
+            category=category, manufacturer=self.manufacturer)
+
+    def collect(self, queryset, size, **kwargs):
+        objects, cursor = [], None
+        while True:
+            page = queryset.keyset_page(cursor, size=size, **kwargs)
+            objects.extend(page)
+            if not page.has_next:
+                return objects
+            cursor = page.next_cursor
+
+    def test_cursor_round_trip(self):
+        self.assertEqual(decode_cursor(encode_cursor([None, u'Awl', 3])),
+            [None, u'Awl', 3])
+
+    def test_pages_follow_node_order_by(self):
+        expected = list(Item.objects.order_by('order', 'name', 'pk'))
+        for size in (1, 2, 3, 7, 20):
+            self.assertEqual(self.collect(Item.objects, size), expected)
+
+    def test_last_page_has_no_cursor(self):
+        page = Item.objects.keyset_page(size=7)
+        self.assertEqual(len(page), 7)
+        self.assertFalse(page.has_next)
+        self.assertEqual(page.next_cursor, None)
+
+    def test_null_order_cursor(self):
+        expected = list(Item.objects.order_by('order', 'name', 'pk'))
+        null_index = [i for i, item in enumerate(expected)
+            if item.order is None][0]
+        page = Item.objects.keyset_page(size=null_index + 1)
+        self.assertEqual(decode_cursor(page.next_cursor)[0], None)
+        rest = Item.objects.keyset_page(page.next_cursor, size=20)
+        self.assertEqual(list(page) + list(rest), expected)
+
+    def test_descending_fields(self):
+        self.assertEqual(self.collect(Item.objects, 2, ordering=['-name']),
+            list(Item.objects.order_by('-name', 'pk')))
+        self.assertEqual(self.collect(Item.objects, 2, ordering=['-order']),
+            list(Item.objects.order_by('-order', 'pk')))
+
+    def test_path_ordering(self):
+        self.assertEqual(self.collect(Category.objects, 1, ordering=['path']),
+            list(Category.objects.order_by('path')))
+
+    def test_subtree_filter(self):
+        items = self.collect(Item.objects.in_category(self.tools), 2)
+        self.assertEqual(items, list(Item.objects
+            .exclude(category=self.paint).order_by('order', 'name', 'pk')))
+        self.assertEqual(
+            [item.name for item in Item.objects.in_category(self.saws)
+                .keyset_page(size=5, ordering=['name'])],
+            ['Awl', 'Chisel', 'Chisel'])
+
+    def test_insert_does_not_shift_pages(self):
+        first = Item.objects.keyset_page(size=3)
+        second = list(Item.objects.keyset_page(first.next_cursor, size=3))
+        self.make_item(0, 'Anvil', self.paint)
+        self.assertEqual(
+            list(Item.objects.keyset_page(first.next_cursor, size=3)), second)
+
+    def test_invalid_cursor(self):
+        self.assertRaises(ValueError, Item.objects.keyset_page, 'not a cursor')
+        self.assertRaises(ValueError, Item.objects.keyset_page,
+            encode_cursor({'pk': 1}))
+        self.assertRaises(ValueError, Item.objects.keyset_page,
+            encode_cursor([1]))
+
+    def page_query(self, cursor, size):
+        qs = Item.objects.all()
+        fields = qs._keyset_fields(Item.node_order_by)
+        qs = qs._keyset_after(fields, decode_cursor(cursor))
+        return qs._keyset_ordered(fields)[:size + 1].query.sql_with_params()
+
+    def test_cursor_bounds_leading_field(self):
+        cursor = Item.objects.filter(order__isnull=False) \
+            .keyset_page(size=1).next_cursor
+        sql, params = self.page_query(cursor, 3)
+        self.assertTrue(re.search(r'WHERE \(*"items_item"\."order" >= %s +AND ',
+            sql), sql)
+
+    def test_deep_page_uses_index(self):
+        if connection.vendor != 'sqlite':
+            return
+        cursor = Item.objects.filter(order__isnull=False) \
+            .keyset_page(size=1).next_cursor
+        sql, params = self.page_query(cursor, 3)
+        db_cursor = connection.cursor()
+        db_cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        plan = ' '.join(str(row[-1]) for row in db_cursor.fetchall())
+        self.assertIn('USING INDEX', plan)
+        self.assertIn('order>', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_manager_database(self):
+        self.assertEqual(Category.objects.db_manager('other')
+            .get_query_set().db, 'other')
+        self.assertEqual(Item.objects.db_manager('other')
+            .get_query_set().db, 'other')
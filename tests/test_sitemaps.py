@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_sitemaps
+------------
+
+Tests for the `items.sitemaps` module.
+"""
+
+import gzip
+import json
+import os
+import re
+import shutil
+import tempfile
+from datetime import datetime
+
+from django.test import TestCase
+
+from items import sitemaps
+from items.models import Category, Item, Manufacturer
+
+
+def make_items(count):
+    manufacturer = Manufacturer.objects.create(name='Acme', slug='acme')
+    category = Category.add_root(name='Tools', slug='tools')
+    return [
+        Item.add_root(name='Item %d' % i, slug='item-%d' % i,
+            category=category, manufacturer=manufacturer,
+            _url='/items/%d/' % i)
+        for i in range(count)
+    ]
+
+
+class TestSitemaps(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.items = make_items(7)
+        self.generator = sitemaps.SitemapGenerator(self.directory,
+            'http://example.com', 'http://example.com/sitemaps',
+            models=('Item',), limit=3, chunk_size=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read(self, name):
+        if name.endswith('.gz'):
+            f = gzip.open(os.path.join(self.directory, name))
+        else:
+            f = open(os.path.join(self.directory, name), 'rb')
+        try:
+            return f.read().decode('utf-8')
+        finally:
+            f.close()
+
+    def locs(self, name):
+        return re.findall(r'<loc>(.*?)</loc>', self.read(name))
+
+    def names(self, items):
+        return ['item-%s.xml.gz' % item.pk for item in items]
+
+    def test_default_limit(self):
+        self.assertEqual(sitemaps.SITEMAP_LIMIT, 50000)
+
+    def test_iter_urls_in_chunks(self):
+        with self.assertNumQueries(4):
+            rows = list(sitemaps.iter_urls('Item', chunk_size=2))
+        self.assertEqual([row[0] for row in rows],
+            [item.pk for item in self.items])
+        self.assertEqual(rows[0][1], '/items/0/')
+
+    def test_iter_urls_skips_missing_url(self):
+        Item.objects.filter(pk=self.items[0].pk).update(_url=None)
+        pks = [row[0] for row in sitemaps.iter_urls('Item')]
+        self.assertEqual(pks, [item.pk for item in self.items[1:]])
+
+    def test_split_files(self):
+        written = self.generator.generate()
+        first = [self.items[0], self.items[3], self.items[6]]
+        self.assertEqual(written, self.names(first))
+        self.assertEqual(self.locs(written[0]), [
+            'http://example.com/items/%d/' % i for i in range(3)
+        ])
+        self.assertEqual(len(self.locs(written[2])), 1)
+
+    def test_index_and_manifest(self):
+        written = self.generator.generate()
+        self.assertEqual(self.locs(sitemaps.INDEX_NAME), [
+            'http://example.com/sitemaps/' + name for name in written
+        ])
+        self.assertTrue(re.search(r'<lastmod>[^<]+[+-]\d\d:\d\d</lastmod>',
+            self.read(sitemaps.INDEX_NAME)))
+
+        manifest = json.loads(self.read(sitemaps.MANIFEST_NAME))
+        entries = manifest['Item']
+        self.assertEqual([e['name'] for e in entries], written)
+        self.assertEqual([e['count'] for e in entries], [3, 3, 1])
+        self.assertEqual(entries[1]['first'], self.items[3].pk)
+
+    def test_stale_files_removed(self):
+        open(os.path.join(self.directory, 'item-0.xml.gz'), 'wb').close()
+        self.generator.generate()
+        self.assertFalse(os.path.exists(
+            os.path.join(self.directory, 'item-0.xml.gz')))
+
+    def test_prune_leaves_other_files(self):
+        for name in ('other.xml.gz', 'category-1.xml.gz'):
+            open(os.path.join(self.directory, name), 'wb').close()
+        for name in ('item-1.xml.gz.tmp', 'sitemap.xml.tmp'):
+            open(os.path.join(self.directory, name), 'wb').close()
+        self.generator.generate()
+        self.assertEqual(sorted(os.listdir(self.directory)), sorted(
+            self.names([self.items[0], self.items[3], self.items[6]]) + [
+                'category-1.xml.gz', 'other.xml.gz',
+                sitemaps.INDEX_NAME, sitemaps.MANIFEST_NAME,
+            ]))
+
+    def test_incremental_unchanged(self):
+        self.generator.generate()
+        self.assertEqual(self.generator.generate(incremental=True), [])
+
+    def test_incremental_insert(self):
+        self.generator.generate()
+        item = make_items(1)[0]
+        written = self.generator.generate(incremental=True)
+        self.assertEqual(written, self.names([self.items[6]]))
+        self.assertEqual(self.locs(written[0])[-1],
+            'http://example.com/items/0/')
+        self.assertEqual(len(self.locs(written[0])), 2)
+        self.assertTrue(item.pk > self.items[6].pk)
+
+    def test_incremental_delete_keeps_name(self):
+        self.generator.generate()
+        name = self.names([self.items[3]])
+        self.items[3].delete()
+        written = self.generator.generate(incremental=True)
+        self.assertEqual(written, name)
+        self.assertEqual(len(self.locs(written[0])), 2)
+
+    def test_incremental_edit(self):
+        self.generator.generate()
+        item = Item.objects.get(pk=self.items[1].pk)
+        item._url = '/renamed/'
+        item.save()
+        written = self.generator.generate(incremental=True)
+        self.assertEqual(written, self.names([self.items[0]]))
+        self.assertIn('http://example.com/renamed/', self.locs(written[0]))
+
+    def test_incremental_overflow_splits(self):
+        self.generator.generate()
+        make_items(3)
+        written = self.generator.generate(incremental=True)
+        self.assertEqual(len(written), 2)
+        self.assertEqual(written[0], self.names([self.items[6]])[0])
+
+    def test_naive_timestamp_has_offset(self):
+        value = sitemaps._timestamp(datetime(2013, 8, 15, 12, 0))
+        self.assertTrue(re.search(r'[+-]\d\d:\d\d$', value))